@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
-import argparse, json, os, re
-import pandas as pd
-import numpy as np
-from typing import Dict, Any
+import argparse, csv, json, os, re
+from concurrent.futures import ProcessPoolExecutor
+import orjson
+from typing import Dict, Any, List, Optional, Tuple
 
 LABELS = ["FABRICATION","ADMISSION","SILENT_REFUSAL","NULL"]
+COLUMNS = ["file", "model", "domain", "n"] + [f"count_{l}" for l in LABELS]
+PCT_COLUMNS = [f"pct_{l}" for l in LABELS]
+STATS_SUFFIXES = ("_stats.json",)
 
 def extract_counts(d: Dict[str,Any]) -> Dict[str,int]:
     """Try multiple known shapes for counts."""
@@ -63,80 +66,124 @@ def extract_n(d: Dict[str,Any], counts: Dict[str,int]) -> int:
         n = sum(int(v) for v in counts.values()) if counts else 0
     return int(n)
 
-def main(in_dir, out_csv):
-    rows = []
-    
-    for fn in os.listdir(in_dir):
-        if not fn.endswith("_stats.json"): 
-            continue
-        
-        fp = os.path.join(in_dir, fn)
+def _process_file(path: str) -> Tuple[Dict[str,List[Any]], Optional[str]]:
+    """Parse one *_stats.json file into column lists; returns (columns, error)."""
+    fn = os.path.basename(path)
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
         try:
-            with open(fp, "r") as f:
-                data = json.load(f)
-        except Exception as e:
-            print(f"Warning: Could not parse {fn}: {e}")
-            continue
-        
-        domain = infer_domain_from_filename(fn)
-        
-        # Check if this has a by_model structure
-        if "by_model" in data and isinstance(data["by_model"], dict):
-            # Nested structure: iterate through each model
-            for model_name, model_data in data["by_model"].items():
-                counts = extract_counts(model_data)
-                n = extract_n(model_data, counts)
-                
-                row = {
-                    "file": fn, 
-                    "model": model_name, 
-                    "domain": domain, 
-                    "n": n
-                }
-                for lab in LABELS:
-                    row[f"count_{lab}"] = counts.get(lab, 0)
-                rows.append(row)
-        else:
-            # Flat structure: single model per file
-            counts = extract_counts(data)
-            model = data.get("model") or data.get("model_name") or "unknown"
-            n = extract_n(data, counts)
-            
-            row = {
-                "file": fn, 
-                "model": model, 
-                "domain": domain, 
-                "n": n
-            }
-            for lab in LABELS:
-                row[f"count_{lab}"] = counts.get(lab, 0)
-            rows.append(row)
+            data = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # orjson rejects NaN/Infinity, which json.dump writes by default
+            data = json.loads(raw)
+    except Exception as e:
+        return {}, str(e)
+    
+    domain = infer_domain_from_filename(fn)
+    cols = {c: [] for c in COLUMNS}
+    
+    # Check if this has a by_model structure
+    if "by_model" in data and isinstance(data["by_model"], dict):
+        # Nested structure: one row per model
+        entries = list(data["by_model"].items())
+    else:
+        # Flat structure: single model per file
+        entries = [(data.get("model") or data.get("model_name") or "unknown", data)]
+    
+    for model, model_data in entries:
+        counts = extract_counts(model_data)
+        cols["file"].append(fn)
+        cols["model"].append(model)
+        cols["domain"].append(domain)
+        cols["n"].append(extract_n(model_data, counts))
+        for lab in LABELS:
+            cols[f"count_{lab}"].append(counts.get(lab, 0))
+    
+    return cols, None
+
+def _write_csv_fast(cols: Dict[str,List[Any]], out_path: str) -> List[str]:
+    """Write the sorted table with pct_ columns via csv; returns models in output order."""
+    n_rows = len(cols["file"])
+    order = sorted(range(n_rows), key=lambda i: (cols["model"][i], cols["domain"][i], cols["file"][i]))
     
-    if not rows:
+    with open(out_path, "w", newline="") as f:
+        w = csv.writer(f, lineterminator="\n")
+        w.writerow(COLUMNS + PCT_COLUMNS)
+        for i in order:
+            n = cols["n"][i]
+            # Empty cell for undefined percentages, matching pandas' NaN output
+            pcts = [cols[f"count_{lab}"][i] / n if n > 0 else "" for lab in LABELS]
+            w.writerow([cols[c][i] for c in COLUMNS] + pcts)
+    
+    return list(dict.fromkeys(cols["model"][i] for i in order))
+
+def main(in_dir, out_path, fast=False):
+    cols = {c: [] for c in COLUMNS}
+    
+    with os.scandir(in_dir) as it:
+        # DirEntry caches name, path and file type, so no extra join/stat per entry
+        paths = [e.path for e in it if e.name.endswith(STATS_SUFFIXES) and e.is_file()]
+    
+    # Files are independent, so parse them across worker processes
+    if paths:
+        chunksize = max(1, len(paths) // ((os.cpu_count() or 1) * 4))
+        with ProcessPoolExecutor() as ex:
+            for path, (file_cols, err) in zip(paths, ex.map(_process_file, paths, chunksize=chunksize)):
+                if err is not None:
+                    print(f"Warning: Could not parse {os.path.basename(path)}: {err}")
+                    continue
+                for c in COLUMNS:
+                    cols[c].extend(file_cols[c])
+    
+    if not cols["file"]:
         print(f"Warning: No valid stats files found in {in_dir}")
+    
+    if fast:
+        models = _write_csv_fast(cols, out_path)
+        print(f"Wrote {out_path} with {len(cols['file'])} rows.")
+        if models:
+            print(f"Models found: {models}")
+        return
+    
+    # Imported here so --fast runs never pay for loading pandas
+    import numpy as np
+    import pandas as pd
+    
+    if not cols["file"]:
         # Create empty dataframe with expected columns
-        df = pd.DataFrame(columns=["file", "model", "domain", "n"] + 
-                                  [f"count_{l}" for l in LABELS] + 
-                                  [f"pct_{l}" for l in LABELS])
+        df = pd.DataFrame(columns=COLUMNS + PCT_COLUMNS)
     else:
-        df = pd.DataFrame(rows).sort_values(["model","domain","file"])
+        # Build from typed columns directly rather than a list of row dicts
+        df = pd.DataFrame({
+            c: (np.asarray(v, dtype=np.int64) if c == "n" or c.startswith("count_") else v)
+            for c, v in cols.items()
+        }).sort_values(["model","domain","file"])
         
-        # Calculate percentages
-        for lab in LABELS:
-            df[f"pct_{lab}"] = np.where(
-                df["n"].astype(float) > 0, 
-                df[f"count_{lab}"] / df["n"], 
-                np.nan
-            )
+        # Calculate percentages in one pass over the (N, 4) count block
+        counts_arr = df[[f"count_{l}" for l in LABELS]].to_numpy(dtype=np.float64)
+        n_arr = df["n"].to_numpy(dtype=np.float64)[:, None]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pct = np.where(n_arr > 0, counts_arr / np.where(n_arr == 0, 1, n_arr), np.nan)
+        df[PCT_COLUMNS] = pct
     
-    df.to_csv(out_csv, index=False)
-    print(f"Wrote {out_csv} with {len(df)} rows.")
+    # Output format follows the file suffix: .parquet (snappy) or CSV
+    if out_path.endswith(".parquet"):
+        df.to_parquet(out_path, engine="pyarrow", compression="snappy", index=False)
+    else:
+        df.to_csv(out_path, index=False)
+    print(f"Wrote {out_path} with {len(df)} rows.")
     if len(df) > 0:
         print(f"Models found: {df['model'].unique().tolist()}")
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("--in_dir", required=True)
-    ap.add_argument("--out_csv", required=True)
+    ap.add_argument("--out", "--out_csv", dest="out", required=True,
+                    help="Output table path (*.csv or *.parquet)")
+    ap.add_argument("--fast", action="store_true",
+                    help="Write CSV with the stdlib csv module instead of pandas")
     args = ap.parse_args()
-    main(args.in_dir, args.out_csv)
+    if args.fast and args.out.endswith(".parquet"):
+        ap.error("--fast only writes CSV; drop it to write Parquet")
+    main(args.in_dir, args.out, fast=args.fast)
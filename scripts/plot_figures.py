@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
 import argparse, os
 import pandas as pd
+import matplotlib
+matplotlib.use("Agg")
+matplotlib.rcParams["interactive"] = False
 import matplotlib.pyplot as plt
 
-def main(tables_csv, figdir):
+def main(tables_path, figdir):
     os.makedirs(figdir, exist_ok=True)
-    df = pd.read_csv(tables_csv)
+    if tables_path.endswith(".parquet"):
+        df = pd.read_parquet(tables_path)
+    else:
+        df = pd.read_csv(tables_path)
     agg = df.groupby("model").sum(numeric_only=True)
-    agg["n"] = agg[[c for c in agg.columns if c.startswith("count_")]].sum(axis=1)
+    counts_df = agg.filter(like="count_")
+    agg["n"] = counts_df.sum(axis=1)
     parts = ["FABRICATION","ADMISSION","SILENT_REFUSAL","NULL"]
-    pct = agg[[f"count_{p}" for p in parts]].div(agg["n"], axis=0)
+    pct = counts_df[[f"count_{p}" for p in parts]].div(agg["n"].where(agg["n"] > 0), axis=0)
 
     ax = pct.plot(kind="bar", figsize=(8,5))
     ax.set_ylabel("Proportion")
@@ -23,7 +30,8 @@ def main(tables_csv, figdir):
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
-    ap.add_argument("--tables_csv", required=True)
+    ap.add_argument("--tables", "--tables_csv", dest="tables", required=True,
+                    help="Metrics table from compute_metrics.py (*.csv or *.parquet)")
     ap.add_argument("--figdir", required=True)
     args = ap.parse_args()
-    main(args.tables_csv, args.figdir)
+    main(args.tables, args.figdir)
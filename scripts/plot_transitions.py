@@ -4,23 +4,59 @@ Compute and plot turn-by-turn transition matrices from persistence study data.
 """
 import argparse
 import json
+import mmap
 import os
-from collections import defaultdict
+import re
+from functools import lru_cache
 import numpy as np
+import orjson
+import matplotlib
+matplotlib.use("Agg")
+matplotlib.rcParams["interactive"] = False
 import matplotlib.pyplot as plt
-import warnings
 
-# Suppress tight_layout warning
-warnings.filterwarnings('ignore', message='.*tight_layout.*')
+try:
+    import ijson
+except ImportError:  # optional: only used to stream very large files
+    ijson = None
+
+try:
+    from numba import njit
+except ImportError:  # optional: compute_transition_matrix falls back to np.bincount
+    njit = None
 
 LABELS = ["FABRICATION", "ADMISSION", "SILENT_REFUSAL", "NULL"]
+LABEL_IDX = {lab: i for i, lab in enumerate(LABELS)}
+
+# Files at least this large are streamed with ijson (if installed) to cap memory.
+# ijson does not accept NaN/Infinity, so such files must be strict JSON.
+_STREAM_MIN_BYTES = 256 * 1024 * 1024
+
+# Only these item fields are needed to build sequences
+_ITEM_FIELDS = ("condition_id", "seed", "turn_index", "classification", "label", "state")
+
+_SEP_RE = re.compile(r"[-\s]")
+
+# Known spellings resolved without substring scanning
+_CANON_MAP = {
+    "FABRICATION": "FABRICATION", "FAB": "FABRICATION", "HALLUCINATION": "FABRICATION",
+    "ADMISSION": "ADMISSION", "ADM": "ADMISSION", "ADMIT": "ADMISSION",
+    "SILENT_REFUSAL": "SILENT_REFUSAL", "SILENTREFUSAL": "SILENT_REFUSAL",
+    "REF": "SILENT_REFUSAL", "REFUSAL": "SILENT_REFUSAL",
+    "NULL": "NULL", "NONE": "NULL", "EMPTY": "NULL",
+}
 
+@lru_cache(maxsize=256)
 def canonicalize_label(label):
-    """Normalize label strings to canonical form."""
+    """Normalize label strings to canonical form (memoized; label sets are tiny)."""
     if label is None:
         return None
     
-    s = str(label).strip().upper().replace(" ", "_").replace("-", "_")
+    s = _SEP_RE.sub("_", str(label).strip().upper())
+    
+    canonical = _CANON_MAP.get(s)
+    if canonical is not None:
+        return canonical
     
     # Map variations to canonical labels
     if "FAB" in s or "HALLUCIN" in s:
@@ -36,76 +72,167 @@ def canonicalize_label(label):
     else:
         return None
 
-def load_sequences(json_path):
+def _iter_items_streaming(f):
     """
-    Load and group results by sequence.
-    In persistence studies, turns have DIFFERENT dedupe_keys but share (condition_id, seed).
+    Yield (model, item) pairs from an open binary file using ijson events.
+    Only the fields in _ITEM_FIELDS are kept, so long response text is never built.
+    """
+    saw_results_map = False
+    fallback_items = []
+    
+    model = None
+    item_prefix = None
+    field_prefixes = {}
+    item = None
+    
+    for prefix, event, value in ijson.parse(f, use_float=True):
+        if prefix == "results":
+            if event == "start_map":
+                saw_results_map = True
+            elif event == "map_key" and saw_results_map:
+                model = value
+                item_prefix = f"results.{model}.item"
+                field_prefixes = {f"{item_prefix}.{k}": k for k in _ITEM_FIELDS}
+            continue
+        
+        if prefix == "items.item" and not saw_results_map:
+            # Top-level "items" list: used only when there is no results map
+            model = "unknown"
+            item_prefix = "items.item"
+            field_prefixes = {f"{item_prefix}.{k}": k for k in _ITEM_FIELDS}
+        
+        if prefix == item_prefix:
+            if event == "start_map":
+                item = {}
+            elif event == "end_map" and item is not None:
+                if item_prefix == "items.item":
+                    fallback_items.append((model, item))
+                else:
+                    yield model, item
+                item = None
+        elif item is not None and event not in ("start_map", "start_array", "map_key"):
+            key = field_prefixes.get(prefix)
+            if key is not None:
+                item[key] = value
+    
+    if not saw_results_map:
+        yield from fallback_items
+
+def _iter_items(json_path):
+    """
+    Yield (model, item) pairs. Files are memory-mapped and parsed with orjson;
+    very large files are streamed with ijson instead when it is installed.
     """
-    with open(json_path) as f:
-        data = json.load(f)
+    if ijson is not None and os.path.getsize(json_path) >= _STREAM_MIN_BYTES:
+        with open(json_path, "rb") as f:
+            yield from _iter_items_streaming(f)
+        return
+    
+    with open(json_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as buf:
+                try:
+                    data = orjson.loads(buf)
+                except orjson.JSONDecodeError:
+                    # orjson rejects NaN/Infinity, which json.dump writes by default
+                    data = json.loads(bytes(buf))
     
     if "results" in data and isinstance(data["results"], dict):
         results = data["results"]
     else:
         results = {"unknown": data.get("items", [])}
     
-    sequences_by_model = {}
-    
     for model, items in results.items():
         if not isinstance(items, list):
             continue
+        for item in items:
+            yield model, item
+
+def load_sequences(json_path):
+    """
+    Load and group results by sequence.
+    In persistence studies, turns have DIFFERENT dedupe_keys but share (condition_id, seed).
+    Each sequence is a (turn_index, label_idx int8) pair of arrays; turn_index keeps the
+    original values and label_idx indexes into LABELS.
+    """
+    # Per model: interned sequence ids plus parallel turn/label columns
+    columns_by_model = {}
+    
+    for model, item in _iter_items(json_path):
+        # Group by (condition_id, seed) for multi-turn sequences
+        condition = item.get("condition_id", "default")
+        seed = item.get("seed", 0)
+        seq_key = f"{condition}_{seed}"
         
-        sequences = defaultdict(list)
+        label = item.get("classification") or item.get("label") or item.get("state")
+        canonical_label = canonicalize_label(label)
         
-        for item in items:
-            # Group by (condition_id, seed) for multi-turn sequences
-            condition = item.get("condition_id", "default")
-            seed = item.get("seed", 0)
-            seq_key = f"{condition}_{seed}"
-            
-            label = item.get("classification") or item.get("label") or item.get("state")
-            canonical_label = canonicalize_label(label)
-            
-            if canonical_label:
-                sequences[seq_key].append({
-                    "turn_index": item.get("turn_index", 0),
-                    "label": canonical_label
-                })
+        if canonical_label:
+            key_ids, seq_ids, turns, labs = columns_by_model.setdefault(model, ({}, [], [], []))
+            seq_ids.append(key_ids.setdefault(seq_key, len(key_ids)))
+            turns.append(item.get("turn_index", 0))
+            labs.append(LABEL_IDX[canonical_label])
+    
+    # One stable lexsort per model lays each sequence out as a contiguous run
+    # ordered by turn_index; runs are then split off at sequence-id changes
+    sequences_by_model = {}
+    for model, (key_ids, seq_ids, turns, labs) in columns_by_model.items():
+        turns_arr = np.asarray(turns)
+        if turns_arr.dtype.kind in "biuf":
+            order = np.lexsort((turns_arr, seq_ids))
+        else:
+            # Non-numeric turn_index values (e.g. null) are compared as-is, like sorted() did
+            turns_arr = np.array(turns, dtype=object)
+            order = np.array(sorted(range(len(turns)), key=lambda i: (seq_ids[i], turns[i])), dtype=np.intp)
         
-        # Sort each sequence by turn_index
-        for key in sequences:
-            sequences[key] = sorted(sequences[key], key=lambda x: x["turn_index"])
+        seq_ids = np.asarray(seq_ids, dtype=np.int64)[order]
+        turns = turns_arr[order]
+        labs = np.asarray(labs, dtype=np.int8)[order]
+        bounds = np.flatnonzero(np.diff(seq_ids)) + 1
         
-        if sequences:
-            sequences_by_model[model] = sequences
+        # Ids were assigned in key_ids insertion order, so runs line up with its keys
+        sequences_by_model[model] = dict(zip(key_ids, zip(np.split(turns, bounds), np.split(labs, bounds))))
     
     return sequences_by_model
 
+if njit is not None:
+    @njit(cache=True, nogil=True)
+    def _accum_transitions(labs, bounds, counts):
+        """Add turn N -> N+1 counts for each run labs[bounds[s]:bounds[s+1]]."""
+        for s in range(bounds.shape[0] - 1):
+            for i in range(bounds[s], bounds[s + 1] - 1):
+                counts[labs[i], labs[i + 1]] += 1
+else:
+    _accum_transitions = None
+
 def compute_transition_matrix(sequences):
     """Compute transition counts from turn N to turn N+1."""
-    transitions = {lab: {lab2: 0 for lab2 in LABELS} for lab in LABELS}
+    n_labels = len(LABELS)
+    seqs = [labs for _, labs in sequences.values() if len(labs) >= 2]
+    counts = np.zeros((n_labels, n_labels), dtype=np.int64)
     
-    for seq_items in sequences.values():
-        if len(seq_items) < 2:
-            continue
+    if seqs:
+        # One flat label buffer plus run offsets
+        flat = np.concatenate(seqs)
+        bounds = np.zeros(len(seqs) + 1, dtype=np.int64)
+        np.cumsum([len(labs) for labs in seqs], out=bounds[1:])
         
-        for i in range(len(seq_items) - 1):
-            from_label = seq_items[i]["label"]
-            to_label = seq_items[i + 1]["label"]
-            
-            if from_label in LABELS and to_label in LABELS:
-                transitions[from_label][to_label] += 1
-    
-    # Convert to numpy array
-    matrix = np.zeros((len(LABELS), len(LABELS)))
-    for i, from_lab in enumerate(LABELS):
-        for j, to_lab in enumerate(LABELS):
-            matrix[i, j] = transitions[from_lab][to_lab]
-    
-    # Normalize by row
+        if _accum_transitions is not None:
+            _accum_transitions(flat, bounds, counts)
+        else:
+            # Encode each (turn N, turn N+1) pair as a flat cell index, dropping
+            # the pairs that straddle two sequences
+            keep = np.ones(len(flat) - 1, dtype=bool)
+            keep[bounds[1:-1] - 1] = False
+            pairs = flat[:-1] * n_labels + flat[1:]
+            counts += np.bincount(pairs[keep], minlength=n_labels * n_labels).reshape(n_labels, n_labels)
+    
+    matrix = counts.astype(np.float64)
+    
+    # Normalize by row, writing straight into the output (empty rows stay 0)
     row_sums = matrix.sum(axis=1, keepdims=True)
-    with np.errstate(divide='ignore', invalid='ignore'):
-        matrix_norm = np.where(row_sums > 0, matrix / row_sums, 0.0)
+    matrix_norm = np.zeros_like(matrix)
+    np.divide(matrix, row_sums, out=matrix_norm, where=row_sums > 0)
     
     return matrix, matrix_norm
 
@@ -120,18 +247,24 @@ def plot_all_transitions(sequences_by_model, figdir):
     
     cols = min(3, n_models)
     rows = (n_models + cols - 1) // cols
-    fig, axes = plt.subplots(rows, cols, figsize=(6 * cols, 5 * rows))
+    fig, axes = plt.subplots(rows, cols, figsize=(6 * cols, 5 * rows), dpi=150)
+    # Margins are fixed below; keep any layout engine from re-running at save time
+    fig.set_layout_engine(None)
     
-    if n_models == 1:
-        axes = [axes]
-    else:
-        axes = axes.flatten() if hasattr(axes, 'flatten') else axes
+    # Fixed margins (in inches) sized for the tick labels, titles and colorbar,
+    # so the saved figure needs no bbox_inches='tight' measuring pass
+    width, height = fig.get_size_inches()
+    fig.subplots_adjust(left=1.3 / width, right=1 - 0.9 / width,
+                        bottom=0.85 / height, top=1 - 0.7 / height,
+                        wspace=0.3, hspace=0.35)
+    
+    axes = axes.flatten() if hasattr(axes, 'flatten') else np.array([axes])
     
     for idx, (model, sequences) in enumerate(sequences_by_model.items()):
         ax = axes[idx]
         _, matrix_norm = compute_transition_matrix(sequences)
         
-        im = ax.imshow(matrix_norm, cmap='YlOrRd', vmin=0, vmax=1)
+        im = ax.imshow(matrix_norm, cmap='YlOrRd', vmin=0, vmax=1, rasterized=True)
         
         ax.set_xticks(range(len(LABELS)))
         ax.set_yticks(range(len(LABELS)))
@@ -159,37 +292,38 @@ def plot_all_transitions(sequences_by_model, figdir):
     
     fig.colorbar(im, ax=axes.tolist(), fraction=0.02, pad=0.04, label="Transition Probability")
     
-    plt.suptitle("Turn-by-Turn Transition Dynamics (Persistence Study)", fontsize=13, fontweight='bold')
-    plt.tight_layout()
+    fig.suptitle("Turn-by-Turn Transition Dynamics (Persistence Study)", fontsize=13, fontweight='bold')
     
+    # Render once straight through the Agg canvas (dpi comes from the figure)
     out_path = os.path.join(figdir, "figure2_transition_matrices.png")
-    plt.savefig(out_path, dpi=200, bbox_inches='tight')
+    with open(out_path, "wb") as fout:
+        fig.canvas.print_png(fout)
     print(f"Saved {out_path}")
 
 def main(in_dir, figdir):
-    persistence_files = [
-        f for f in os.listdir(in_dir)
-        if f.startswith("persistence_") and f.endswith(".json") and "_stats" not in f
-    ]
+    with os.scandir(in_dir) as it:
+        persistence_entries = [
+            e for e in it
+            if e.name.startswith("persistence_") and e.name.endswith(".json") and "_stats" not in e.name
+        ]
     
-    if not persistence_files:
+    if not persistence_entries:
         print(f"Warning: No persistence JSON files found in {in_dir}")
         return
     
     all_sequences = {}
     
-    for filename in persistence_files:
-        json_path = os.path.join(in_dir, filename)
+    for entry in persistence_entries:
+        filename = entry.name
         print(f"Loading sequences from {filename}")
         
-        sequences_by_model = load_sequences(json_path)
+        sequences_by_model = load_sequences(entry.path)
         
         for model, sequences in sequences_by_model.items():
-            if model not in all_sequences:
-                all_sequences[model] = {}
-            for seq_key, seq_items in sequences.items():
-                unique_key = f"{filename}:{seq_key}"
-                all_sequences[model][unique_key] = seq_items
+            # (filename, seq_key) tuples keep sequences from different files apart
+            all_sequences.setdefault(model, {}).update(
+                ((filename, seq_key), seq) for seq_key, seq in sequences.items()
+            )
     
     if not all_sequences:
         print("Warning: No valid sequences found")
@@ -198,7 +332,7 @@ def main(in_dir, figdir):
     print(f"Found {len(all_sequences)} models:")
     for model, seqs in all_sequences.items():
         # Count multi-turn sequences
-        multi_turn = sum(1 for seq in seqs.values() if len(seq) >= 2)
+        multi_turn = sum(1 for _, labs in seqs.values() if len(labs) >= 2)
         print(f"  {model}: {len(seqs)} sequences ({multi_turn} with 2+ turns)")
     
     plot_all_transitions(all_sequences, figdir)